@@ -12,7 +12,7 @@ import yaml
 
 
 def read_sites_file(sample, settings):
-    return pd.read_csv(settings.path + sample + '_sites.txt', sep='\t')
+    return pd.read_csv(settings.sites_file(sample), sep='\t')
 
 
 def nfifty(sample, settings):
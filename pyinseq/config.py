@@ -31,3 +31,6 @@ bowtie = os.path.join(packages_folder, default_version, 'bowtie')
 
 # PATH TO BOWTIE-BUILD (appends '-build' on the path above)
 bowtieBuild = '{bowtiepath}-build'.format(bowtiepath=bowtie)
+
+# The windows bowtie binaries do not support memory-mapped indexes (--mm)
+bowtieMemoryMap = not platform.startswith('win')
@@ -7,111 +7,297 @@ Output path includes the experiment and sample name:
 
 '''
 
-import collections
-import csv
-import gzip
+import contextlib
+import functools
+import io
+import itertools
 import logging
-import regex as re
-import screed
-import sys
-from .utils import convert_to_filename
+import multiprocessing
+import numpy as np
+import pyinseq.config as config
+from .utils import convert_to_filename, BARCODE_LENGTH
+try:
+    # Intel ISA-L backed gzip; same API as the standard library module
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 logger = logging.getLogger('pyinseq')
 
+# Bytes of FASTQ data read, classified and written at once; this bounds the
+# demultiplexed data held in memory
+CHUNK_SIZE = 4 << 20
+# Write buffer of each demultiplexed output file
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Template of a FASTQ record from its name, sequence and quality bytes
+FASTQ_RECORD = b'@%b\n%b\n+\n%b\n'
+
+# Read layout: 4-bp barcode, 16-17 bp of chromosomal sequence ending in the
+# TA insertion site, then the flanking transposon sequence
+TRANSPOSON_SITE = ('TA' + config.transposonLeft).encode()
+CHROM_SEQ_START = 4
+CHROM_SEQ_LENGTHS = (16, 17)
+# Lookup table of the unambiguous DNA bases by byte value
+ACGT_TABLE = np.zeros(256, dtype=bool)
+ACGT_TABLE[list(b'ACGT')] = True
+# 2-bit code of each base by byte value, for packing barcodes
+BASE_CODES = np.zeros(256, dtype=np.uint8)
+BASE_CODES[list(b'ACGT')] = np.arange(4, dtype=np.uint8)
+# Number of distinct packed barcodes
+BARCODES = 4 ** BARCODE_LENGTH
+
+
+class ReadBucket(bytearray):
+    """FASTQ records kept as one contiguous bytearray until they are written.
+
+       Records are added in place with += (no object kept per read).
+    """
+    def write(self, fo):
+        """Write the records to the open file fo and empty the bucket."""
+        fo.write(self)
+        self.clear()
+
 
 def demultiplex_fastq(reads, samplesDict, settings):
     """Demultiplex a fastq input file by 5' barcode into separate files.
 
-       Use regex to identify the chromosome slice and save this in the read
-       record as 'trim', e.g., read['trim'] = (4, 21)
+       Reads are processed in chunks of raw bytes (see demultiplex_chunk),
+       in parallel across settings.threads processes when it is above 1.
+       Chunks are written in input order.
        Save raw reads into '{experiment}/raw_data/{sampleName}.fastq'
        Save trimmed reads into '{experiment}/{sampleName}_trimmed.fastq'
     """
-    # Dictionary of lists to hold FASTQ reads until they are written to files
-    # Keys are barcodes
-    demultiplex_dict = {}
-    for sample in samplesDict:
-        bc = samplesDict[sample]['barcode']
-        demultiplex_dict[bc] = []
-    demultiplex_dict['other'] = []  # unassigned barcodes
+    # Samples are numbered in samplesDict order; unassigned barcodes go to
+    # the last index ('other')
+    barcodes = [samplesDict[sample]['barcode'] for sample in samplesDict]
+    nsamples = len(barcodes)
+    barcode_lut = barcode_lookup(barcodes, settings.barcode_mismatches)
+    process_chunk = functools.partial(demultiplex_chunk,
+                                      barcode_lut=barcode_lut,
+                                      nsamples=nsamples,
+                                      trim=settings.write_trimmed_reads)
     # count of reads
     nreads = 0
-    # For each line in the FASTQ file:
-    #   Assign to barcode (fastq record into the dictionary)
-    #   Cache by barcode; write to the appropriate output files (untrimmed and trimmed)
-    pattern = re.compile('''
-    ^                               # beginning of string
-    ([ACGT]{4})                     # group(1) = barcode, any 4-bp of mixed ACGT
-    ([NACGT][ACGT]{13,14}(?:TA))    # group(2) = 16-17 bp of chromosomal sequence
-                                    # first bp can be N
-                                    # last two must be TA for transposon
-    ACAGGTTG                        # flanking transposon sequence
-    ''', re.VERBOSE)
-    with screed.open(reads) as seqfile:
-        for read in seqfile:
-            m = re.search(pattern, read.sequence)
-            try:
-                barcode, chrom_seq = m.group(1), m.group(2)
-                if barcode in demultiplex_dict:
-                    read['trim'] = m.span(2)  # trim slice
-                    demultiplex_dict[barcode].append(read)
-                else:
-                    demultiplex_dict['other'].append(read)
-            except:
-                demultiplex_dict['other'].append(read)
-            # Every 10^6 sequences write and clear the dictionary
-            nreads += 1
-            if nreads % 5E6 == 0:
-                logger.info('Demultiplexed {:,} samples'.format(nreads))
-                write_reads(demultiplex_dict, samplesDict, settings)
-                # Write trimmed reads only when needed
-                if settings.write_trimmed_reads:
-                    write_trimmed_reads(demultiplex_dict, samplesDict, settings)
-                # Clear the dictionary after writing to file
-                for sampleName in demultiplex_dict:
-                    demultiplex_dict[sampleName] = []
-    write_reads(demultiplex_dict, samplesDict, settings)
-    # Write trimmed reads only when needed
-    if settings.write_trimmed_reads:
-        write_trimmed_reads(demultiplex_dict, samplesDict, settings)
-    logger.info('Total records demultiplexed: {:,}'.format(nreads))
+    # For each chunk of the FASTQ file:
+    #   Assign each read to barcode (fastq record into the sample's bucket)
+    #   Write the chunk's buckets to the appropriate output files (untrimmed and trimmed)
+    # Only the current chunk (or batch of chunks, with threads) is held in
+    # memory; the buffered output files coalesce the writes
+    with contextlib.ExitStack() as stack:
+        raw_files, trimmed_files = open_output_files(samplesDict, settings, stack)
+        chunks = read_fastq_chunks(reads)
+        if settings.threads > 1:
+            pool = stack.enter_context(multiprocessing.Pool(settings.threads))
+            # A few chunks per worker at a time so the reader cannot run
+            # ahead of the workers and hold the whole input in memory
+            batches = iter(lambda: list(itertools.islice(chunks, 2 * settings.threads)), [])
+            results = (result for batch in batches for result in pool.map(process_chunk, batch))
+        else:
+            results = map(process_chunk, chunks)
+        for chunk_reads, raw_buckets, trimmed_buckets in results:
+            write_reads(raw_buckets, raw_files)
+            # Trimmed files are only open when trimmed reads are written
+            write_reads(trimmed_buckets, trimmed_files)
+            # Report progress every 5 x 10^6 sequences
+            if (nreads + chunk_reads) // 5000000 > nreads // 5000000:
+                logger.info('Demultiplexed %s samples', format(nreads + chunk_reads, ','))
+            nreads += chunk_reads
+    logger.info('Total records demultiplexed: %s', format(nreads, ','))
     return nreads
 
 
-def write_reads(demultiplex_dict, samplesDict, settings):
-    """Write the fastq data to the correct (demultiplexed) file."""
-    # inverting the value: key pairs to barcode: sample, and also adding 'other': '_other'
-    barcode_dict = {'other': '_other'}
-    for sample in samplesDict:
-        barcode_dict[samplesDict[sample]['barcode']] = sample
-    for barcode in demultiplex_dict:
-        if demultiplex_dict[barcode]:
-            with open('{path}raw_data/{sample}.fastq'.format(
-                      path=settings.path,
-                      sample=barcode_dict[barcode]), 'a') as fo:
-                for read in demultiplex_dict[barcode]:
-                    fo.write('@{n}\n{s}\n+\n{q}\n'.format(
-                        n=read.name,
-                        s=read.sequence,
-                        q=read.quality))
-
-
-def write_trimmed_reads(demultiplex_dict, samplesDict, settings):
-    """Write the fastq data to the correct (demultiplexed) file."""
-    # inverting the value: key pairs to barcode: sample. Exclude 'other' here
-    barcode_dict = {}
-    for sample in samplesDict:
-        barcode_dict[samplesDict[sample]['barcode']] = sample
-    for barcode in demultiplex_dict:
-        if barcode != 'other':
-            with open('{path}/{sample}_trimmed.fastq'.format(
-                      path=settings.path,
-                      sample=barcode_dict[barcode]), 'a') as fo:
-                for read in demultiplex_dict[barcode]:
-                    fo.write('@{n}\n{s}\n+\n{q}\n'.format(
-                        n=read.name,
-                        s=read.sequence[slice(read.trim[0], read.trim[1])],
-                        q=read.quality[slice(read.trim[0], read.trim[1])]))
+def demultiplex_chunk(chunk_newlines, barcode_lut, nsamples, trim=True):
+    """Demultiplex one (chunk, newlines) pair from read_fastq_chunks.
+
+       The barcode and the chromosome slice of every read in the chunk are
+       found at once with NumPy; barcodes are looked up in barcode_lut (from
+       barcode_lookup). Reads are assigned to a sample when both
+       match, otherwise to 'other' (sample number nsamples).
+       Returns (nreads, raw_buckets, trimmed_buckets), with buckets indexed
+       by sample number; trimmed_buckets is empty unless trim is True.
+    """
+    chunk, newlines = chunk_newlines
+    other_idx = nsamples
+    raw_buckets = [ReadBucket() for _ in range(nsamples + 1)]
+    trimmed_buckets = [ReadBucket() for _ in range(nsamples)] if trim else []
+    # First 4 bytes of each sequence line
+    seq_starts = newlines[0::4] + 1
+    arr = np.frombuffer(chunk, dtype=np.uint8)
+    bases = arr[seq_starts[:, None] + np.arange(BARCODE_LENGTH)]
+    # End of the chromosomal sequence in each read (0 if no match)
+    trim_ends = chromosome_slice_ends(arr, seq_starts, newlines[1::4])
+    # A matching chromosome slice already implies an ACGT barcode
+    sample_idx = np.where(trim_ends > 0, barcode_lut[pack_barcodes(bases)],
+                          other_idx).tolist()
+    for idx, trim_end, (name, seq, qual) in zip(sample_idx, trim_ends.tolist(),
+                                                iter_fastq(chunk)):
+        raw_buckets[idx] += FASTQ_RECORD % (name, seq, qual)
+        if idx != other_idx and trim:
+            trimmed_buckets[idx] += FASTQ_RECORD % (
+                name, seq[CHROM_SEQ_START:trim_end], qual[CHROM_SEQ_START:trim_end])
+    return len(sample_idx), raw_buckets, trimmed_buckets
+
+
+def barcode_lookup(barcodes, mismatches=0):
+    """Return a lookup table of sample number by packed barcode.
+
+       A 4-bp barcode packs into one byte at 2 bits per base (see
+       pack_barcodes), so the table has 256 entries indexed by the packed
+       barcode. Entries of barcodes that belong to no sample hold
+       len(barcodes) ('other'); barcodes that are not 4 unambiguous bases
+       can never match a read and are left out.
+       With mismatches=1 every 1-bp variant of a barcode is added for its
+       sample, unless the variant is itself a barcode or is 1 bp from the
+       barcodes of two different samples.
+    """
+    lookup = {}
+    for idx, bc in enumerate(barcodes):
+        lookup[bc] = idx
+    if mismatches:
+        variants = {}
+        for idx, bc in enumerate(barcodes):
+            for i in range(len(bc)):
+                for base in 'ACGT':
+                    variant = bc[:i] + base + bc[i + 1:]
+                    if variant not in lookup:
+                        variants.setdefault(variant, set()).add(idx)
+        for variant, samples in variants.items():
+            if len(samples) == 1:
+                lookup[variant] = samples.pop()
+    barcode_lut = np.full(BARCODES, len(barcodes), dtype=np.intp)
+    for bc, idx in lookup.items():
+        bases = np.frombuffer(bc.encode(), dtype=np.uint8)
+        if len(bases) == BARCODE_LENGTH and ACGT_TABLE[bases].all():
+            barcode_lut[pack_barcodes(bases[None, :])[0]] = idx
+    return barcode_lut
+
+
+def pack_barcodes(bases):
+    """Pack rows of 4 ACGT bytes (uint8 array of shape (n, 4)) into uint8.
+
+       Each base is 2 bits (A, C, G, T = 0, 1, 2, 3), first base highest.
+       Bytes other than ACGT pack as A; callers mask them with ACGT_TABLE.
+    """
+    codes = BASE_CODES[bases]
+    return (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3]
+
+
+def chromosome_slice_ends(arr, seq_starts, seq_ends):
+    """Return the end of the chromosomal sequence slice of each read.
+
+       arr is a uint8 view of a FASTQ chunk and seq_starts/seq_ends are the
+       offsets of each sequence line in it. Matches reads of the form
+       [ACGT]{4} [NACGT][ACGT]{13,14}TA ACAGGTTG
+       i.e., barcode, chromosomal sequence (first bp can be N; ends in the
+       TA of the insertion site), flanking transposon sequence.
+       The slice starts at CHROM_SEQ_START; reads that do not match get 0.
+    """
+    site = np.frombuffer(TRANSPOSON_SITE, dtype=np.uint8)
+    # The TA of the insertion site can only be at one of two offsets
+    first = CHROM_SEQ_START + CHROM_SEQ_LENGTHS[0] - 2
+    last = CHROM_SEQ_START + CHROM_SEQ_LENGTHS[1] - 2
+    lengths = seq_ends - seq_starts
+    last_byte = len(arr) - 1
+    trim_ends = np.zeros(len(seq_starts), dtype=np.intp)
+    # At most one offset can match: the site starts with T then A
+    for pos in (first, last):
+        # Filter on the first and last byte of the site (bounded to the chunk
+        # for short final reads), then verify whole candidates only
+        candidates = np.flatnonzero(
+            (lengths >= pos + len(site)) &
+            (arr[np.minimum(seq_starts + pos, last_byte)] == site[0]) &
+            (arr[np.minimum(seq_starts + pos + len(site) - 1, last_byte)] == site[-1]))
+        seqs = arr[seq_starts[candidates, None] + np.arange(pos + len(site))]
+        # Everything before the transposon must be ACGT, except that the
+        # first bp of chromosomal sequence can be N
+        is_base = ACGT_TABLE[seqs[:, :pos]]
+        is_base[:, CHROM_SEQ_START] |= seqs[:, CHROM_SEQ_START] == ord('N')
+        match = (seqs[:, pos:] == site).all(axis=1) & is_base.all(axis=1)
+        trim_ends[candidates[match]] = pos + 2
+    return trim_ends
+
+
+def iter_fastq(chunk):
+    """Yield (name, sequence, quality) bytes for each record in a FASTQ chunk.
+
+       The chunk must hold complete 4-line records, as from read_fastq_chunks.
+       All lines are split at once; no Record object is built per read.
+    """
+    lines = chunk.split(b'\n')
+    return zip((name[1:] for name in lines[0:-1:4]), lines[1::4], lines[3::4])
+
+
+def open_fastq(reads):
+    """Open a plain or gzipped FASTQ file (detected from the magic bytes) for reading."""
+    with open(reads, 'rb') as fi:
+        gzipped = fi.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return io.BufferedReader(gzip.open(reads, 'rb'), buffer_size=256 << 10)
+    return open(reads, 'rb', buffering=256 << 10)
+
+
+def read_fastq_chunks(reads, chunk_size=CHUNK_SIZE):
+    """Yield (chunk, newlines) for a plain or gzipped FASTQ file.
+
+       Each chunk is a bytes object holding only complete 4-line records;
+       newlines is a NumPy array of the offsets of every newline in it.
+    """
+    # One buffer is reused for every read; it starts with the incomplete
+    # record left over from the previous chunk
+    buf = bytearray(chunk_size)
+    filled = 0
+    with open_fastq(reads) as fastq:
+        while True:
+            if filled == len(buf):
+                # Not even one complete record in the buffer
+                buf.extend(bytes(len(buf)))
+            with memoryview(buf) as view:
+                n = fastq.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+            newlines = np.flatnonzero(
+                np.frombuffer(buf, dtype=np.uint8, count=filled) == ord('\n'))
+            end = 4 * (len(newlines) // 4)
+            if end:
+                last = newlines[end - 1] + 1
+                with memoryview(buf) as view:
+                    yield bytes(view[:last]), newlines[:end]
+                buf[:filled - last] = buf[last:filled]
+                filled -= last
+    tail = bytes(buf[:filled])
+    # Last record may be missing its final newline
+    if tail.strip():
+        tail = tail.rstrip(b'\n') + b'\n'
+        newlines = np.flatnonzero(np.frombuffer(tail, dtype=np.uint8) == ord('\n'))
+        if len(newlines) != 4:
+            raise IOError('Error: truncated FASTQ record at the end of {0}'.format(reads))
+        yield tail, newlines
+
+
+def open_output_files(samplesDict, settings, stack):
+    """Open the raw (and trimmed) output file of every sample once.
+
+       Files are registered on the contextlib.ExitStack so they stay open
+       for the whole demultiplex pass and are closed when it exits.
+       Returns (raw_files, trimmed_files), lists indexed by sample number;
+       raw_files ends with the file for unassigned reads ('_other').
+    """
+    raw_files = [stack.enter_context(open(
+        settings.raw_fastq(sample), 'wb', buffering=OUTPUT_BUFFER_SIZE))
+        for sample in list(samplesDict) + ['_other']]
+    trimmed_files = []
+    if settings.write_trimmed_reads:
+        trimmed_files = [stack.enter_context(open(
+            settings.trimmed_fastq(sample), 'wb', buffering=OUTPUT_BUFFER_SIZE))
+            for sample in samplesDict]
+    return raw_files, trimmed_files
+
+
+def write_reads(buckets, files):
+    """Write and clear each bucket of fastq data to its (demultiplexed) file."""
+    for bucket, fo in zip(buckets, files):
+        bucket.write(fo)
 
 
 def main():
@@ -1,35 +1,63 @@
 #!/usr/bin/env python3
 
+import contextlib
 import os
 import logging
 import re
+import signal
 import subprocess
+import threading
 import pyinseq.config as config
 
 logger = logging.getLogger('pyinseq')
 
 
-def bowtie_build(organism):
-    '''Build a bowtie index given a fasta nucleotide file.'''
+def bowtie_build(organism, cwd=None):
+    '''Build a bowtie index in cwd given a fasta nucleotide file there.'''
     fna = organism + '.fna'
-    subprocess.check_call([config.bowtieBuild, '-q', fna, organism])
+    subprocess.check_call([config.bowtieBuild, '-q', fna, organism], cwd=cwd)
 
 
-def bowtie_map(organism, reads, bowtieOutput):
-    '''Map fastq reads to a bowtie index.'''
-    fna = organism + '.fna'
-    # String version of the shell command
-    bashCommand = '{0} -m 1 --best --strata -a --fullref -n 1 -l 17 {1} -q {2} {3} -p 2' \
-        .format(config.bowtie, organism, reads, bowtieOutput)
-    # Convert bash command to run properly - no spaces; instead list of entries
-    # that will appear in the shell as space-separated
-    # Consider shlex.split() instead of split() -- any benefit here?
-    # subprocess.check_call(bashCommand.split(' '))
-    proc = subprocess.Popen(bashCommand.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    bowtie_msg_out = proc.communicate()[0]
-    # decode from bytes to unicode
-    bowtie_msg_out = bowtie_msg_out.decode('utf8')
-    return bowtie_msg_out
+def bowtie_index_files(organism):
+    '''Return the names of the index files bowtie_build writes for organism.'''
+    return [organism + suffix for suffix in
+            ('.1.ebwt', '.2.ebwt', '.3.ebwt', '.4.ebwt', '.rev.1.ebwt', '.rev.2.ebwt')]
+
+
+@contextlib.contextmanager
+def bowtie_map(organism, reads, threads=2, cwd=None, memory_map=config.bowtieMemoryMap):
+    '''Map fastq reads to a bowtie index, streaming the alignments.
+
+       Runs bowtie in cwd with threads alignment threads and yields
+       (alignments, messages): alignments iterates over bowtie's output lines
+       as they are produced; messages is a list that holds bowtie's summary
+       text once the with block exits. Raises CalledProcessError if bowtie
+       fails, unless the with block stopped reading alignments early.
+       With memory_map the index is memory-mapped (--mm), so concurrent
+       bowtie processes share one copy of it in memory; this is on by default
+       except on windows, where bowtie does not support it.
+    '''
+    command = [config.bowtie, '-m', '1', '--best', '--strata', '-a', '--fullref',
+               '-n', '1', '-l', '17', organism, '-q', reads, '-p', str(threads)]
+    if memory_map:
+        command.append('--mm')
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, cwd=cwd)
+    messages = []
+    # Drain stderr alongside stdout so that neither pipe can fill and block bowtie
+    stderr_reader = threading.Thread(target=lambda: messages.append(proc.stderr.read()))
+    stderr_reader.start()
+    try:
+        yield proc.stdout, messages
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        stderr_reader.join()
+        proc.stderr.close()
+    # bowtie is killed by SIGPIPE when the with block closes its output early
+    if proc.returncode and proc.returncode != -getattr(signal, 'SIGPIPE', 0):
+        raise subprocess.CalledProcessError(proc.returncode, command,
+                                            stderr=''.join(messages))
 
 
 def parse_bowtie(bowtieMessage):
@@ -37,12 +65,9 @@ def parse_bowtie(bowtieMessage):
     bowtie_msg_dict = {}
     for line in bowtieMessage.split('\n'):
         # extract counts from bowtie printing
-        m = re.search('^(\#.+:) (\d+)', line)
-        try:
-            message, count = m.group(1), int(m.group(2))
-            bowtie_msg_dict[message] = count
-        except:
-            pass
+        m = re.search(r'^(\#.+:) (\d+)', line)
+        if m:
+            bowtie_msg_dict[m.group(1)] = int(m.group(2))
     return bowtie_msg_dict
 
 
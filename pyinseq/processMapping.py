@@ -4,22 +4,31 @@ Counts the bowtie hits at each position in each sample
 
 '''
 
+import collections
+import contextlib
 import csv
 import os
 
 
-def map_sites(sample, samplesDict, settings):
-    '''Map insertions to nucleotide sites.'''
+def map_sites(sample, samplesDict, settings, alignments=None):
+    '''Map insertions to nucleotide sites.
+
+       alignments is an iterable of bowtie output lines (such as the stream
+       from bowtie_map); by default the sample's bowtie file is read.
+       Writes the sample's sites file and returns the number of sites.
+    '''
     # Placeholder for dictionary of mapped reads in format:
     # {(contig, position) : [Lcount, Rcount]}
     mapDict = {}
     # overallTotal = denominator for cpm calculation
     overallTotal = 0
     cpm = 0
-    bowtie_file = settings.path + sample + '_bowtie.txt'
-    sites_file = settings.path + sample + '_sites.txt'
-    with open(bowtie_file, 'r') as fi:
-        for line in fi:
+    bowtie_file = settings.bowtie_out(sample)
+    sites_file = settings.sites_file(sample)
+    with contextlib.ExitStack() as stack:
+        if alignments is None:
+            alignments = stack.enter_context(open(bowtie_file, 'r'))
+        for line in alignments:
             bowtiedata = line.rstrip().split('\t')
             # Calculate transposon insertion point = transposonNT
             contig, insertionNT, readLength = str(bowtiedata[2]), int(bowtiedata[3]), len(bowtiedata[4])
@@ -32,7 +41,7 @@ def map_sites(sample, samplesDict, settings):
             overallTotal += 1
     # write tab-delimited of contig/nucleotide/Lcount/Rcount/TotalCount/cpm
     # use the index totalCounts as the denominator for cpm calculation
-    with open(sites_file, 'a') as fo:
+    with open(sites_file, 'w') as fo:
         writer = csv.writer(fo, delimiter='\t', dialect='excel')
         header_entry = ('contig', 'nucleotide', 'left_counts', 'right_counts', 'total_counts', 'cpm')
         writer.writerow(header_entry)
@@ -43,7 +52,7 @@ def map_sites(sample, samplesDict, settings):
             cpm = float(1E6) * totalCounts / overallTotal
             row_entry = (insertion[0], insertion[1], Lcounts, Rcounts, totalCounts, cpm)
             writer.writerow(row_entry)
-    return mapDict
+    return len(mapDict)
 
 
 def map_genes(sample, disruption, settings):
@@ -66,13 +75,13 @@ def map_genes(sample, disruption, settings):
     genome = fttLookup(settings.organism, settings.experiment)
     # list of tuples of each mapped insertion to be immediately written per insertion
     mappedHitList = []
-    # Dictionary with running total of cpm per gene; keys are genes, values are aggregate cpm
+    # Counter with running total of cpm per gene; keys are genes, values are aggregate cpm
     # only hits in the first part of the gene are added to the count, as defined
     # by the disruption threshold.
     # if disruption = 1.0 then every hit in the gene is included
-    geneDict = {}
-    sites_file = settings.path + sample + '_sites.txt'
-    genes_file = settings.path + sample + '_genes.txt'
+    geneDict = collections.Counter()
+    sites_file = settings.sites_file(sample)
+    genes_file = settings.genes_file(sample)
     with open(sites_file, 'r', newline='') as csvfileR:
         sitesReader = csv.reader(csvfileR, delimiter='\t')
         next(sitesReader, None)  # skip the headers
@@ -101,10 +110,8 @@ def map_genes(sample, disruption, settings):
                             mappedHitList.append(mappedHit)
                             # Filter based on location in the gene
                             if threePrimeness <= disruption:
-                                # Add to the total for that gene --
-                                # Single-element list (rather than interger) so
-                                # that it is subscriptable to add cpm counts
-                                geneDict.setdefault(locus_tag, [0])[0] += cpm
+                                # Add to the total for that gene
+                                geneDict[locus_tag] += cpm
                 prevFeature = locus_tag
     # Write individual insertions to *_genes.txt
     with open(genes_file, 'w', newline='') as csvfileW:
@@ -160,10 +167,11 @@ def build_gene_table(organism, sample_dict, gene_mappings, experiment=''):
                 # matches based on locusTag.
                 # In future should I instead create an index field in the .ftt?
                 if hitLocusTag == fttLocusTag:
-                    gene_table[i][currentColumn] += mapped_genes[gene][0]
-        with open('results/{0}/summary_gene_table.txt'.format(experiment), 'w') as fo:
-            writer = csv.writer(fo, delimiter='\t', dialect='excel')
-            writer.writerows(gene_table)
+                    gene_table[i][currentColumn] += mapped_genes[gene]
+    # Write the table once after all samples are added
+    with open('results/{0}/summary_gene_table.txt'.format(experiment), 'w') as fo:
+        writer = csv.writer(fo, delimiter='\t', dialect='excel')
+        writer.writerows(gene_table)
 
 
 def fttLookup(organism, experiment=''):
@@ -175,17 +183,12 @@ def fttLookup(organism, experiment=''):
 
     # TODO: Error checking when generating the ftt file that locus tags are \
     # unique and complete.
-    fttList = []
     with open('results/{0}/genome_lookup/{1}.ftt'.format(experiment, organism), newline='') as csvfile:
         fttreader = csv.reader(csvfile, delimiter='\t')
-        for line in fttreader:
-            # ignore header row
-            if line[0] != ('Locus'):
-                # Locus, Location_Start, Location_End, Strand, Length, PID,
-                # Gene, Synonym, Code, COG, Product
-                featureData = [line[0], line[1], line[2], line[3], line[4],
-                               line[5], line[6], line[7], line[8], line[9], line[10]]
-                fttList.append(featureData)
+        # Locus, Location_Start, Location_End, Strand, Length, PID,
+        # Gene, Synonym, Code, COG, Product
+        # ignore header row
+        fttList = [line[0:11] for line in fttreader if line[0] != 'Locus']
     return fttList
 
 
@@ -2,35 +2,53 @@
 
 '''Main script for running the pyinseq package.'''
 import argparse
-import csv
-import glob
+import atexit
+import concurrent.futures
+import contextlib
+import functools
 import logging
 import os
 import numpy as np
 import pandas as pd
-import regex as re
-import screed
 import subprocess
+import shutil
 import sys
+import tempfile
 import yaml
 from shutil import copyfile
 from collections import OrderedDict
+try:
+    # libyaml C implementation; same API as the pure-Python classes
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
 from .analyze import read_sites_file, nfifty, plot_insertions
 from .demultiplex import demultiplex_fastq, write_reads
 from .gbkconvert import gbk2fna, gbk2ftt
-from .mapReads import bowtie_build, bowtie_map, parse_bowtie
+from .mapReads import bowtie_build, bowtie_index_files, bowtie_map, parse_bowtie
 from .processMapping import map_sites, map_genes, build_gene_table
-from .utils import convert_to_filename, create_experiment_directories  # has logging config
+from .utils import convert_to_filename, create_experiment_directories, \
+    tab_delimited_samples_to_dict, default_cache_dir, genome_cache_path, \
+    restore_from_cache, save_to_cache, log_queue_listener, \
+    init_worker_logging, PyinseqError, available_cpus, BARCODE_LENGTH  # has logging config
 
 # Note: stdout logging is set in utils.py
 logger = logging.getLogger('pyinseq')
 logger.setLevel(logging.INFO)
 
+def positive_int(value):
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1: {}'.format(value))
+    return number
+
+
 def parseArgs(args):
     """Parse command line arguments."""
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input',
-                        help='input Illumina reads file or folder',
+                        help='input Illumina reads file',
                         required=True)
     parser.add_argument('-s', '--samples',
                         help='sample list with barcodes',
@@ -38,12 +56,37 @@ def parseArgs(args):
     parser.add_argument('-e', '--experiment',
                         help='experiment name (no spaces or special characters)',
                         required=True)
+    parser.add_argument('--force',
+                        help='write into the experiment directory even if it already exists',
+                        action='store_true',
+                        default=False)
     parser.add_argument('-g', '--genome',
                         help='genome in GenBank format (one concatenated file for multiple contigs/chromosomes)',
                         required=True)
     parser.add_argument('-d', '--disruption',
                         help='fraction of gene disrupted (0.0 - 1.0)',
                         default=1.0)
+    parser.add_argument('--mismatches',
+                        help='barcode mismatches allowed when demultiplexing (0 or 1)',
+                        type=int,
+                        choices=[0, 1],
+                        default=0)
+    parser.add_argument('-t', '--threads',
+                        help='number of processes to use (default: CPUs available)',
+                        type=positive_int,
+                        default=available_cpus())
+    parser.add_argument('--no-cache',
+                        help='do not reuse or save cached genome files and bowtie indexes',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--cache-dir',
+                        help='directory for cached genome files and bowtie indexes \
+                        (default $XDG_CACHE_HOME/pyinseq or ~/.cache/pyinseq)',
+                        default=default_cache_dir())
+    parser.add_argument('--shm',
+                        help='copy the bowtie index to /dev/shm for mapping',
+                        action='store_true',
+                        default=False)
     '''Inactive arguments in current version
     parser.add_argument('-s', '--samples',
                         help='sample list with barcodes. \
@@ -70,7 +113,7 @@ def demultiplex_parseArgs(args):
     """Parse command line arguments for `pyinseq demultiplex`."""
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input',
-                        help='input Illumina reads file or folder',
+                        help='input Illumina reads file',
                         required=True)
     parser.add_argument('-s', '--samples',
                         help='sample list with barcodes',
@@ -78,10 +121,23 @@ def demultiplex_parseArgs(args):
     parser.add_argument('-e', '--experiment',
                         help='experiment name (no spaces or special characters)',
                         required=True)
+    parser.add_argument('--force',
+                        help='write into the experiment directory even if it already exists',
+                        action='store_true',
+                        default=False)
     parser.add_argument('--notrim',
                         help='do not write trimmed reads (i.e. write raw reads only)',
                         action='store_true',
                         required=False)
+    parser.add_argument('--mismatches',
+                        help='barcode mismatches allowed when demultiplexing (0 or 1)',
+                        type=int,
+                        choices=[0, 1],
+                        default=0)
+    parser.add_argument('-t', '--threads',
+                        help='number of processes to use (default: CPUs available)',
+                        type=positive_int,
+                        default=available_cpus())
     return parser.parse_args(args)
 
 
@@ -91,6 +147,10 @@ def genomeprep_parseArgs(args):
     parser.add_argument('-e', '--experiment',
                         help='experiment name (no spaces or special characters)',
                         required=True)
+    parser.add_argument('--force',
+                        help='write into the experiment directory even if it already exists',
+                        action='store_true',
+                        default=False)
     parser.add_argument('-g', '--genome',
                         help='genome in GenBank format (one concatenated file for multiple contigs/chromosomes)',
                         required=True)
@@ -98,22 +158,17 @@ def genomeprep_parseArgs(args):
                         help='do not generate bowtie indexes',
                         action='store_true',
                         required=False)
+    parser.add_argument('--no-cache',
+                        help='do not reuse or save cached genome files and bowtie indexes',
+                        action='store_true',
+                        default=False)
+    parser.add_argument('--cache-dir',
+                        help='directory for cached genome files and bowtie indexes \
+                        (default $XDG_CACHE_HOME/pyinseq or ~/.cache/pyinseq)',
+                        default=default_cache_dir())
     return parser.parse_args(args)
 
 
-class cd:
-    """Context manager to change to the specified directory then back."""
-    def __init__(self, newPath):
-        self.newPath = os.path.expanduser(newPath)
-
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
-
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
-
-
 class Settings():
     """Instantiate to set up settings for the experiment."""
     def __init__(self, experiment_name):
@@ -125,6 +180,8 @@ class Settings():
         self.genome_path = self.path + 'genome_lookup/'
         # organism reference files called 'genome.fna' etc
         self.organism = 'genome'
+        # bowtie index used for mapping, relative to genome_path unless absolute
+        self.bowtie_index = self.organism
         self.raw_path = self.path + 'raw_data/'
         self.generate_bowtie_index = True
         self.process_reads = True
@@ -135,12 +192,36 @@ class Settings():
         self.write_trimmed_reads = True
         # may be modified
         self.keepall = False
-        self.barcode_length = 4
+        self.barcode_length = BARCODE_LENGTH
+        self.barcode_mismatches = 0
+        self.threads = 1
+        # Cache subdirectory for this run's genome files (None: no caching)
+        self.genome_cache = None
+        # Reuse an existing experiment directory (--force)
+        self.allow_existing = False
+        # Map from a copy of the bowtie index in /dev/shm (--shm)
+        self.shm_index = False
 
     def __repr__(self):
         # Print each variable on a separate line
         return '\n'.join('%s: %s' % item for item in vars(self).items())
 
+    # Per-sample file paths; every step builds them here so they cannot drift
+    def raw_fastq(self, sample):
+        return self.raw_path + sample + '.fastq'
+
+    def trimmed_fastq(self, sample):
+        return self.path + sample + '_trimmed.fastq'
+
+    def bowtie_out(self, sample):
+        return self.path + sample + '_bowtie.txt'
+
+    def sites_file(self, sample):
+        return self.path + sample + '_sites.txt'
+
+    def genes_file(self, sample):
+        return self.path + sample + '_genes.txt'
+
     def set_command_specific_settings(self, cmd):
         if cmd == 'demultiplex':
             self.command = 'demultiplex'
@@ -153,124 +234,195 @@ class Settings():
             self.process_sample_list = False
             self.map_to_genome = False
 
-def set_paths(experiment_name):
-    """Set up relative paths for subdirectories."""
-    experiment = convert_to_filename(experiment_name)
-    samples_yaml = 'results/{}/samples.yml'.format(experiment)
-    summary_log = 'results/{}/log.txt'.format(experiment)
-    path = {'experiment': experiment,
-            'samples_yaml': samples_yaml,
-            'summary_log': summary_log}
-    return path
-
 
 def set_disruption(d):
     """Check that gene disrution is 0.0 to 1.0; otherwise set to 1.0."""
     if d < 0.0 or d > 1.0:
-        logger.error('Disruption value provided ({0}) is not in range 0.0 to 1.0; proceeding with default value of 1.0'.format(d))
+        logger.error('Disruption value provided (%s) is not in range 0.0 to 1.0; proceeding with default value of 1.0', d)
         d = 1.0
     return d
 
 
-def tab_delimited_samples_to_dict(sample_file):
-    """Read sample names, barcodes from tab-delimited into an OrderedDict."""
-    samplesDict = OrderedDict()
-    with open(sample_file, 'r', newline='') as csvfile:
-        for line in csv.reader(csvfile, delimiter='\t'):
-            if not line[0].startswith('#'):  # ignore comment lines in original file
-                # sample > filename-acceptable string
-                # barcode > uppercase
-                sample = convert_to_filename(line[0])
-                barcode = line[1].upper()
-                if sample not in samplesDict and barcode not in samplesDict.values():
-                        samplesDict[sample] = {'barcode': barcode}
-                else:
-                    raise IOError('Error: duplicate sample {0} barcode {1}'.format(sample, barcode))
-    return samplesDict
-
-
 def yaml_samples_to_dict(sample_file):
     """Read sample names, barcodes from yaml into an OrderedDict."""
     with open(sample_file, 'r') as f:
-        samplesDict = yaml.load(sample_file)
+        samplesDict = OrderedDict(yaml.load(f, Loader=SafeLoader))
     return samplesDict
 
 
-def directory_of_samples_to_dict(directory):
-    """Read sample names from a directory of .gz files into an OrderedDict."""
-    samplesDict = OrderedDict()
-    for gzfile in list_files(directory):
-        # TODO(convert internal periods to underscore? use regex?)
-        # extract file name before any periods
-        f = (os.path.splitext(os.path.basename(gzfile))[0].split('.')[0])
-        samplesDict[f] = {}
-    return samplesDict
+def check_input_paths(settings, args):
+    """Raise PyinseqError if an input file given in args is missing.
 
+       Reads are demultiplexed by the sample list barcodes, so a sample list
+       is required whenever reads are processed.
 
-def list_files(folder, ext='gz'):
-    """Return list of .gz files from the specified folder."""
-    with cd(folder):
-        return [f for f in glob.glob('*.{}'.format(ext))]
+       Checked before any work is done, so a mistyped path fails at once
+       rather than after the experiment directories are made.
+    """
+    inputs = []
+    if settings.process_reads:
+        if not args.samples:
+            raise PyinseqError('PyINSeq Error: a sample list (-s) is needed to demultiplex reads')
+        inputs.append(('input reads', args.input))
+    if settings.process_sample_list and args.samples:
+        inputs.append(('sample list', args.samples))
+    if settings.parse_genbank_file:
+        inputs.append(('genome', args.genome))
+    for description, path in inputs:
+        if not os.path.exists(path):
+            raise PyinseqError('PyINSeq Error: {0} not found: {1}'.format(description, path))
+        if not os.path.isfile(path):
+            raise PyinseqError('PyINSeq Error: {0} is not a file: {1}'.format(description, path))
 
 
 def build_fna_and_ftt_files(gbkfile, settings):
-    """Convert GenBank file to a fasta nucleotide and feature table files."""
+    """Convert GenBank file to a fasta nucleotide and feature table files.
+
+       Files from an earlier run on the same GenBank file are copied from
+       settings.genome_cache instead, when it is set.
+    """
+    genome_files = [settings.organism + '.fna', settings.organism + '.ftt']
+    if settings.genome_cache and \
+            restore_from_cache(settings.genome_cache, genome_files, settings.genome_path):
+        logger.info('Using cached genome files from %s', settings.genome_cache)
+        return
     gbk2fna(gbkfile, settings.organism, settings.genome_path)
     gbk2ftt(gbkfile, settings.organism, settings.genome_path)
+    if settings.genome_cache:
+        save_to_cache(settings.genome_cache, genome_files, settings.genome_path)
 
 
 def build_bowtie_index(settings):
-    """Change directory, build bowtie indexes, and change directory back."""
-    with cd(settings.genome_path):
-        logger.info('Building bowtie index files in results/{}/genome_lookup'.format(settings.experiment))
-        bowtie_build(settings.organism)
+    """Build bowtie indexes in the genome_lookup directory.
+
+       As with the genome files, a cached index is reused when there is one.
+    """
+    index_files = bowtie_index_files(settings.organism)
+    if settings.genome_cache and \
+            restore_from_cache(settings.genome_cache, index_files, settings.genome_path):
+        logger.info('Using cached bowtie index files from %s', settings.genome_cache)
+        return
+    logger.info('Building bowtie index files in results/%s/genome_lookup', settings.experiment)
+    bowtie_build(settings.organism, cwd=settings.genome_path)
+    if settings.genome_cache:
+        save_to_cache(settings.genome_cache, index_files, settings.genome_path)
+
+
+def stage_bowtie_index(settings, shm='/dev/shm'):
+    """Copy the bowtie index into a directory in shm and map from there.
+
+       The copy is removed when pyinseq exits. If shm does not exist or has
+       too little free space, the index in genome_lookup is left in use.
+    """
+    index_files = [os.path.join(settings.genome_path, f)
+                   for f in bowtie_index_files(settings.organism)]
+    if not os.path.isdir(shm):
+        logger.info('%s not found; mapping from the bowtie index in %s',
+                    shm, settings.genome_path)
+        return
+    needed = sum(os.path.getsize(f) for f in index_files)
+    if shutil.disk_usage(shm).free < 2 * needed:
+        logger.info('Not enough space in %s; mapping from the bowtie index in %s',
+                    shm, settings.genome_path)
+        return
+    shm_dir = tempfile.mkdtemp(prefix='pyinseq-{}-'.format(settings.experiment), dir=shm)
+    atexit.register(shutil.rmtree, shm_dir, ignore_errors=True)
+    for f in index_files:
+        copyfile(f, os.path.join(shm_dir, os.path.basename(f)))
+    settings.bowtie_index = os.path.join(shm_dir, settings.organism)
+    logger.info('Mapping from the bowtie index copied to %s', shm_dir)
+
+
+def map_sample(sample, settings, samplesDict, disruption, bowtie_threads=1):
+    """Map one sample's trimmed reads with bowtie, then to sites and genes.
+
+       Returns (bowtie_results, insertion_sites, gene_mappings) for the sample.
+       Module-level so that pipeline_mapping can run it in worker processes.
+    """
+    # bowtie runs in the genome_lookup directory; its output is counted as it
+    # streams in and copied to the sample's bowtie file on the way
+    bowtie_in = os.path.abspath(settings.trimmed_fastq(sample))
+    bowtie_out = settings.bowtie_out(sample)
+    logger.info('Sample %s: map reads with bowtie', sample)
+    logger.info('Sample %s: summarize the site data from the bowtie results', sample)
+    with bowtie_map(settings.bowtie_index, bowtie_in, threads=bowtie_threads,
+                    cwd=settings.genome_path) as (alignments, messages), \
+            open(bowtie_out, 'w') as fo:
+        insertions = map_sites(sample, samplesDict, settings,
+                               alignments=copy_lines(alignments, fo))
+    bowtie_msg_out = ''.join(messages)
+    logger.info('%s', bowtie_msg_out)
+    # Gene-level results for the sample
+    # Filtered on gene fraction disrupted as specified by -d flag
+    logger.info('Sample %s: map site data to genes', sample)
+    gene_mappings = map_genes(sample, disruption, settings)
+    # if not settings.keepall:
+    #    # Delete trimmed fastq file, bowtie mapping file after writing mapping results
+    #    os.remove(s['trimmedPath'])
+    #    os.remove('results/{0}/{1}'.format(Settings.experiment, bowtieOutputFile))
+    return parse_bowtie(bowtie_msg_out), insertions, gene_mappings
+
+
+def copy_lines(lines, fo):
+    """Yield each line of lines after writing it to the open file fo."""
+    for line in lines:
+        fo.write(line)
+        yield line
 
 
 def pipeline_mapping(settings, samplesDict, disruption):
-    """Aggregate bowtie output, map to genes in the feature table, and aggregate samples."""
+    """Aggregate bowtie output, map to genes in the feature table, and aggregate samples.
+
+       Returns a dictionary of each sample's bowtie results and number of
+       insertion sites.
+       Samples are independent, so with settings.threads above 1 they are
+       mapped in parallel across that many processes (at most one per sample).
+       The threads are shared out evenly as bowtie alignment threads.
+    """
     # Dictionary of each sample's cpm by gene
     geneMappings = {}
     mapping_data = {}
-    for sample in samplesDict:
-        with cd(settings.genome_path):
-            # Paths are relative to the genome_lookup directory
-            # from where bowtie is called
-            bowtie_in = '../' + sample + '_trimmed.fastq'
-            bowtie_out = '../' + sample + '_bowtie.txt'
-            # map to bowtie and produce the output file
-            logger.info('Sample {}: map reads with bowtie'.format(sample))
-            bowtie_msg_out = bowtie_map(settings.organism, bowtie_in, bowtie_out)
-            logger.info(bowtie_msg_out)
+    samples = list(samplesDict)
+    workers = max(1, min(settings.threads, len(samples)))
+    map_one = functools.partial(map_sample, settings=settings,
+                                samplesDict=samplesDict, disruption=disruption,
+                                bowtie_threads=max(1, settings.threads // workers))
+    with contextlib.ExitStack() as stack:
+        if workers > 1:
+            # Workers log through this process
+            log_queue = stack.enter_context(log_queue_listener())
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=init_worker_logging, initargs=(log_queue,)))
+            # Results come back in sample order
+            results = executor.map(map_one, samples)
+        else:
+            results = map(map_one, samples)
+        for sample, (bowtie_results, insertions, gene_mappings) in zip(samples, results):
             # store bowtie data for each sample in dictionary
-            mapping_data[sample] = {'bowtie_results': [], 'insertion_sites': []}
-            mapping_data[sample]['bowtie_results'] = parse_bowtie(bowtie_msg_out)
-        # Map each bowtie result to the chromosome
-        logger.info('Sample {}: summarize the site data from the bowtie results'.format(sample))
-        insertions = len(map_sites(sample, samplesDict, settings))
-        mapping_data[sample]['insertion_sites'] = insertions
-        # Add gene-level results for the sample to geneMappings
-        # Filtered on gene fraction disrupted as specified by -d flag
-        logger.info('Sample {}: map site data to genes'.format(sample))
-        geneMappings[sample] = map_genes(sample, disruption, settings)
-        # if not settings.keepall:
-        #    # Delete trimmed fastq file, bowtie mapping file after writing mapping results
-        #    os.remove(s['trimmedPath'])
-        #    os.remove('results/{0}/{1}'.format(Settings.experiment, bowtieOutputFile))
-    logger.info('Aggregate gene mapping from all samples into the summary_data_table'.format(sample))
+            mapping_data[sample] = {'bowtie_results': bowtie_results,
+                                    'insertion_sites': insertions}
+            geneMappings[sample] = gene_mappings
+    logger.info('Aggregate gene mapping from all samples into the summary_data_table')
     build_gene_table(settings.organism, samplesDict, geneMappings, settings.experiment)
+    return mapping_data
 
 
 def pipeline_summarize(samplesDict, settings, typed_command_after_pyinseq):
     """Summary of INSeq run."""
-    logger.info('Print samples info: {}'.format(settings.samples_yaml))
+    # Serialized once for both samples.yml and the log
+    # Plain dict so the file can be read back with SafeLoader; dicts keep the
+    # sample order (Python 3.7+) and sort_keys=False writes it unchanged
+    samples_yaml = yaml.dump(dict(samplesDict), Dumper=SafeDumper,
+                             default_flow_style=False, sort_keys=False)
+    logger.info('Print samples info: %s', settings.samples_yaml)
     with open(settings.samples_yaml, 'w') as fo:
-        fo.write(yaml.dump(samplesDict, default_flow_style=False))
+        fo.write(samples_yaml)
 
     # write summary log with more data
-    logger.info('Print summary log: {}'.format(settings.summary_log))
-    logger.info('Print command entered' + '\npyinseq ' + ' '.join(typed_command_after_pyinseq))
-    logger.info('Print settings' + '\n' + str(settings))
-    logger.info('Print samples detail' + '\n' + yaml.dump(samplesDict, default_flow_style=False))
+    logger.info('Print summary log: %s', settings.summary_log)
+    logger.info('Print command entered\npyinseq %s', ' '.join(typed_command_after_pyinseq))
+    logger.info('Print settings\n%s', settings)
+    logger.info('Print samples detail\n%s', samples_yaml)
 
 #def pipeline_analysis(samplesDict, settings):
 #    """Analysis of output."""
@@ -301,42 +453,47 @@ def main(args):
     # Initialize the settings object
     settings = Settings(args.experiment)
     settings.set_command_specific_settings(command)
-    try:
-        # for `pyinseq demultiplex` only
+    settings.allow_existing = args.force
+    if command == 'demultiplex':
         settings.write_trimmed_reads = not args.notrim
-    except:
-        pass
-    try:
-        # for `pyinseq genomeprep` only
+    if command == 'genomeprep':
         settings.generate_bowtie_index = not args.noindex
-        print('args.noindex', args.noindex)
-        print('settings.generate_bowtie_index', settings.generate_bowtie_index)
-    except:
-        pass
+    try:
+        check_input_paths(settings, args)
+    except PyinseqError as e:
+        logger.error(e)
+        sys.exit(2)
     # Keep intermediate files
     settings.keepall = False  # args.keepall
     if settings.process_reads:
         reads = args.input
+        settings.barcode_mismatches = args.mismatches
+        settings.threads = args.threads
+    if command == 'pyinseq':
+        settings.shm_index = args.shm
     if settings.parse_genbank_file:
         gbkfile = args.genome
+        if not args.no_cache:
+            settings.genome_cache = genome_cache_path(gbkfile, args.cache_dir)
         if settings.process_reads:
             disruption = set_disruption(float(args.disruption))
     # sample names and paths
     if settings.process_sample_list:
         samples = args.samples
         # barcodes_present = not args.nobarcodes
-        if samples:
+        try:
             samplesDict = tab_delimited_samples_to_dict(samples)
-        else:
-            reads = os.path.abspath(reads)
-            samplesDict = directory_of_samples_to_dict(samples)
-    try:
-        logger.debug('samplesDict: {0}'.format(samplesDict))
-    except(UnboundLocalError):
-        pass
+        except PyinseqError as e:
+            logger.error(e)
+            sys.exit(2)
+        logger.debug('samplesDict: %s', samplesDict)
 
     # --- SET UP DIRECTORIES --- #
-    create_experiment_directories(settings)
+    try:
+        create_experiment_directories(settings)
+    except PyinseqError as e:
+        logger.error(e)
+        sys.exit(2)
 
     # --- SET UP LOG FILE --- #
     fh = logging.FileHandler(settings.summary_log)
@@ -357,7 +514,12 @@ def main(args):
         build_bowtie_index(settings)
     if settings.map_to_genome:
         logger.info('Map with bowtie')
-        pipeline_mapping(settings, samplesDict, disruption)
+        if settings.shm_index:
+            stage_bowtie_index(settings)
+        mapping_data = pipeline_mapping(settings, samplesDict, disruption)
+        # Record the mapping results with each sample (for samples.yml)
+        for sample in mapping_data:
+            samplesDict[sample].update(mapping_data[sample])
 
     # if not samples:
     #    Settings.summaryDict['total reads'] = 0
@@ -370,7 +532,7 @@ def main(args):
         pipeline_summarize(samplesDict, settings, typed_command_after_pyinseq)
 
     # --- CONFIRM COMPLETION --- #
-    logger.info('***** {} complete! *****'.format(settings.command))
+    logger.info('***** %s complete! *****', settings.command)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 import csv
+import os
+import subprocess
 from collections import OrderedDict
-from pyinseq.runner import Settings, tab_delimited_samples_to_dict
+from pyinseq.runner import Settings, tab_delimited_samples_to_dict, yaml_samples_to_dict, \
+    pipeline_summarize
+from pyinseq.demultiplex import barcode_lookup
+from pyinseq.mapReads import bowtie_map
 from pyinseq import utils
 import numpy as np
 import pandas as pd
+import pytest
 
 # pyinseq.utils
 
@@ -39,6 +45,15 @@ def test_class_Settings_init():
     assert x.barcode_length == 4
 
 
+def test_class_Settings_sample_paths():
+    x = Settings('example')
+    assert x.raw_fastq('s1') == 'results/example/raw_data/s1.fastq'
+    assert x.trimmed_fastq('s1') == 'results/example/s1_trimmed.fastq'
+    assert x.bowtie_out('s1') == 'results/example/s1_bowtie.txt'
+    assert x.sites_file('s1') == 'results/example/s1_sites.txt'
+    assert x.genes_file('s1') == 'results/example/s1_genes.txt'
+
+
 def test_tab_delimited_samples_to_dict_trailing_newline():
     s = 'pyinseq/tests/data/additional/sample01_01.txt'
     assert tab_delimited_samples_to_dict(s) == \
@@ -49,3 +64,78 @@ def test_tab_delimited_samples_to_dict_no_trailing_newline():
     s = 'pyinseq/tests/data/additional/sample01_02.txt'
     assert tab_delimited_samples_to_dict(s) == \
         OrderedDict([('sample_1', {'barcode': 'AAAA'}), ('sample_2', {'barcode': 'TTTT'})])
+
+
+def test_tab_delimited_samples_to_dict_whitespace_and_comments(tmpdir):
+    s = tmpdir.join('samples.txt')
+    s.write_binary(b'# sample\tbarcode\r\nsample_1\tAAAA \r\n\r\nsample_2\tttTT\r\n')
+    assert tab_delimited_samples_to_dict(str(s)) == \
+        OrderedDict([('sample_1', {'barcode': 'AAAA'}), ('sample_2', {'barcode': 'TTTT'})])
+
+
+@pytest.mark.parametrize('barcode', ['AANA', 'AAA', 'AAAAA', 'AA A'])
+def test_tab_delimited_samples_to_dict_invalid_barcode(tmpdir, barcode):
+    s = tmpdir.join('samples.txt')
+    s.write('sample_1\t{}\n'.format(barcode))
+    with pytest.raises(utils.PyinseqError):
+        tab_delimited_samples_to_dict(str(s))
+
+
+def test_tab_delimited_samples_to_dict_duplicate_barcode(tmpdir):
+    s = tmpdir.join('samples.txt')
+    s.write('sample_1\tAAAA\nsample_2\taaaa\n')
+    with pytest.raises(utils.PyinseqError):
+        tab_delimited_samples_to_dict(str(s))
+
+
+def test_yaml_samples_to_dict(tmpdir):
+    s = tmpdir.join('samples.yml')
+    s.write('sample_2:\n  barcode: TTTT\nsample_1:\n  barcode: AAAA\n')
+    assert yaml_samples_to_dict(str(s)) == \
+        OrderedDict([('sample_2', {'barcode': 'TTTT'}), ('sample_1', {'barcode': 'AAAA'})])
+
+
+def test_pipeline_summarize_sample_order(tmpdir):
+    settings = Settings('example')
+    settings.samples_yaml = str(tmpdir.join('samples.yml'))
+    samplesDict = OrderedDict([('sample_2', {'barcode': 'TTTT', 'insertion_sites': 2}),
+                               ('sample_1', {'barcode': 'AAAA', 'insertion_sites': 1})])
+    pipeline_summarize(samplesDict, settings, [])
+    # Samples are written in run order, not sorted (OrderedDict == checks order)
+    assert yaml_samples_to_dict(settings.samples_yaml) == samplesDict
+
+
+# pyinseq.demultiplex
+
+def barcode_lookup_dict(barcodes, mismatches):
+    lut = barcode_lookup(barcodes, mismatches)
+    # packed barcode -> sequence (2 bits per base, first base highest)
+    unpack = [''.join('ACGT'[(packed >> shift) & 3] for shift in (6, 4, 2, 0))
+              for packed in range(len(lut))]
+    return {unpack[packed]: int(idx) for packed, idx in enumerate(lut) if idx != len(barcodes)}
+
+
+def test_barcode_lookup_exact():
+    assert barcode_lookup_dict(['GAAG', 'CTTT'], 0) == {'GAAG': 0, 'CTTT': 1}
+
+
+def test_barcode_lookup_one_mismatch():
+    lookup = barcode_lookup_dict(['AAAA', 'AAAT'], 1)
+    # each barcode keeps its own sample
+    assert lookup['AAAA'] == 0
+    assert lookup['AAAT'] == 1
+    # unambiguous 1-bp variants
+    assert lookup['CAAA'] == 0
+    assert lookup['CAAT'] == 1
+    # 1 bp from both barcodes
+    assert 'AAAC' not in lookup
+
+
+# pyinseq.mapReads
+
+
+def test_bowtie_map_missing_index(tmpdir):
+    reads = os.path.abspath('pyinseq/tests/data/input/example01.fastq')
+    with pytest.raises(subprocess.CalledProcessError):
+        with bowtie_map('nonexistent_index', reads, cwd=str(tmpdir)) as (alignments, messages):
+            list(alignments)
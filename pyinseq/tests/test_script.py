@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
-from .test_utils import runscript, datadir
+from .test_utils import runscript, datadir, scriptpath
 import filecmp
+import os
 import pytest
+import re
+import subprocess
+import sys
+import pyinseq
+from pyinseq.runner import yaml_samples_to_dict
 
 
 def test_pyinseq_script_no_args(datadir, tmpdir):
@@ -20,7 +26,7 @@ def test_pyinseq_script(datadir, tmpdir):
     expected_output = datadir('output_pyinseq')
     output_dir = tmpdir.join('results/example_pyinseq')
 
-    args = ['-i', input_fn, '-s', sample_fn, '-g', gb_fn, '-e', output_name]
+    args = ['-i', input_fn, '-s', sample_fn, '-g', gb_fn, '-e', output_name, '--no-cache']
     status, out, err = runscript('pyinseq', args, directory=str(tmpdir))
 
     assert status == 0
@@ -34,6 +40,72 @@ def test_pyinseq_script(datadir, tmpdir):
     for subdcmp in dcmp.subdirs.values():
         assert subdcmp.diff_files == []
 
+    # Mapping results are kept for every sample
+    samplesDict = yaml_samples_to_dict(str(output_dir.join('samples.yml')))
+    assert list(samplesDict) == ['E001_01', 'E001_02']
+    for sample in samplesDict.values():
+        assert sample['bowtie_results']
+        assert sample['insertion_sites'] > 0
+
+
+def test_pyinseq_script_threads(datadir, tmpdir):
+
+    input_fn = datadir('input/example01.fastq')
+    sample_fn = datadir('input/example01.txt')
+    gb_fn = datadir('input/ES114v2.gb')
+    output_name = 'example_pyinseq_threads'
+    output_dir = tmpdir.join('results/example_pyinseq_threads')
+
+    args = ['-i', input_fn, '-s', sample_fn, '-g', gb_fn, '-e', output_name, '--no-cache',
+            '-t', '2']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir))
+
+    assert status == 0
+
+    # Mapping the samples in worker processes gives the same output
+    dcmp = filecmp.dircmp(datadir('output_pyinseq'),
+                          str(output_dir),
+                          ignore=['E001_01_bowtie.txt', 'E001_02_bowtie.txt'])
+    assert dcmp.diff_files == []
+    for subdcmp in dcmp.subdirs.values():
+        assert subdcmp.diff_files == []
+    # and the workers' log messages reach log.txt
+    log = output_dir.join('log.txt').read()
+    for sample in ('E001_01', 'E001_02'):
+        assert 'Sample {0}: map reads with bowtie'.format(sample) in log
+        assert 'Sample {0}: map site data to genes'.format(sample) in log
+
+
+@pytest.mark.skipif(not os.path.isdir('/dev/shm'), reason='no /dev/shm')
+def test_pyinseq_script_shm(datadir, tmpdir):
+
+    input_fn = datadir('input/example01.fastq')
+    sample_fn = datadir('input/example01.txt')
+    gb_fn = datadir('input/ES114v2.gb')
+    output_name = 'example_pyinseq_shm'
+    output_dir = tmpdir.join('results/example_pyinseq_shm')
+
+    args = ['-i', input_fn, '-s', sample_fn, '-g', gb_fn, '-e', output_name, '--no-cache',
+            '--shm']
+    # In a separate process, so that the copy's atexit cleanup runs before the checks
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(pyinseq.__file__)))
+    subprocess.check_call([sys.executable, os.path.join(scriptpath(), 'pyinseq')] + args,
+                          cwd=str(tmpdir), env=env)
+
+    # Mapping from the copy of the index in /dev/shm gives the same output
+    dcmp = filecmp.dircmp(datadir('output_pyinseq'),
+                          str(output_dir),
+                          ignore=['E001_01_bowtie.txt', 'E001_02_bowtie.txt'])
+    assert dcmp.diff_files == []
+    for subdcmp in dcmp.subdirs.values():
+        assert subdcmp.diff_files == []
+    # and the copy is removed when pyinseq exits
+    log = output_dir.join('log.txt').read()
+    m = re.search(r'Mapping from the bowtie index copied to (\S+)', log)
+    assert m
+    assert m.group(1).startswith('/dev/shm/')
+    assert not os.path.exists(m.group(1))
+
 
 def test_pyinseq_demultiplex_script(datadir, tmpdir):
 
@@ -57,6 +129,27 @@ def test_pyinseq_demultiplex_script(datadir, tmpdir):
         assert subdcmp.diff_files == []
 
 
+def test_pyinseq_demultiplex_script_threads(datadir, tmpdir):
+
+    input_fn = datadir('input/example01.fastq')
+    sample_fn = datadir('input/example01.txt')
+    output_name = 'example_demultiplex_threads'
+    output_dir = tmpdir.join('results/example_demultiplex_threads')
+
+    args = ['demultiplex', '-i', input_fn, '-s', sample_fn, '-e', output_name, '-t', '2']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir))
+
+    assert status == 0
+
+    # Demultiplexing in a pool of worker processes gives the same output
+    dcmp = filecmp.dircmp(datadir('output_demultiplex'),
+                          str(output_dir))
+    assert dcmp.diff_files == []
+    for subdcmp in dcmp.subdirs.values():
+        assert subdcmp.diff_files == []
+    assert 'Total records demultiplexed: 82' in output_dir.join('log.txt').read()
+
+
 def test_pyinseq_demultiplex_notrim_script(datadir, tmpdir):
 
     input_fn = datadir('input/example01.fastq')
@@ -86,7 +179,7 @@ def test_pyinseq_genomeprep_script(datadir, tmpdir):
     output_dir = tmpdir.join('results/example_genomeprep')
     gb_fn = datadir('input/ES114v2.gb')
 
-    args = ['genomeprep', '-e', output_name, '-g', gb_fn]
+    args = ['genomeprep', '-e', output_name, '-g', gb_fn, '--no-cache']
     status, out, err = runscript('pyinseq', args, directory=str(tmpdir))
 
     assert status == 0
@@ -98,3 +191,86 @@ def test_pyinseq_genomeprep_script(datadir, tmpdir):
     # with dircmp object values
     for subdcmp in dcmp.subdirs.values():
         assert subdcmp.diff_files == []
+
+
+def test_pyinseq_genomeprep_script_cached(datadir, tmpdir):
+
+    gb_fn = datadir('input/ES114v2.gb')
+    cache_dir = str(tmpdir.join('cache'))
+
+    # The first run fills the cache, the second copies from it
+    for output_name in ['example_genomeprep_1', 'example_genomeprep_2']:
+        args = ['genomeprep', '-e', output_name, '-g', gb_fn, '--cache-dir', cache_dir]
+        status, out, err = runscript('pyinseq', args, directory=str(tmpdir))
+        assert status == 0
+
+    log = tmpdir.join('results/example_genomeprep_2/log.txt').read()
+    assert 'Using cached genome files' in log
+    assert 'Using cached bowtie index files' in log
+    dcmp = filecmp.dircmp(datadir('output_genomeprep'),
+                          str(tmpdir.join('results/example_genomeprep_2')))
+    for subdcmp in dcmp.subdirs.values():
+        assert subdcmp.diff_files == []
+        assert subdcmp.left_only == []
+
+
+def test_pyinseq_genomeprep_script_existing_directory(datadir, tmpdir):
+
+    gb_fn = datadir('input/ES114v2.gb')
+    args = ['genomeprep', '-e', 'example_genomeprep', '-g', gb_fn, '--no-cache', '--noindex']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir))
+    assert status == 0
+
+    # The experiment directory now exists
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir), fail_ok=True)
+    assert status == 2
+    status, out, err = runscript('pyinseq', args + ['--force'], directory=str(tmpdir))
+    assert status == 0
+
+
+def test_pyinseq_script_missing_input(datadir, tmpdir):
+
+    sample_fn = datadir('input/example01.txt')
+    gb_fn = datadir('input/ES114v2.gb')
+    args = ['-i', str(tmpdir.join('missing.fastq')), '-s', sample_fn, '-g', gb_fn,
+            '-e', 'example_missing', '--no-cache']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir), fail_ok=True)
+
+    assert status == 2
+    # Fails before anything is written
+    assert not tmpdir.join('results/example_missing').check()
+
+
+def test_demultiplex_script_no_sample_list(datadir, tmpdir):
+
+    args = ['demultiplex', '-i', datadir('input'), '-s', '', '-e', 'example_no_samples']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir), fail_ok=True)
+
+    assert status == 2
+    # Fails before anything is written
+    assert not tmpdir.join('results/example_no_samples').check()
+
+
+def test_demultiplex_script_invalid_barcode(datadir, tmpdir):
+
+    sample_fn = tmpdir.join('samples.txt')
+    sample_fn.write('E001_01\tAANA\n')
+    args = ['demultiplex', '-i', datadir('input/example01.fastq'), '-s', str(sample_fn),
+            '-e', 'example_invalid_barcode']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir), fail_ok=True)
+
+    assert status == 2
+    assert 'Traceback' not in err
+    assert not tmpdir.join('results/example_invalid_barcode').check()
+
+
+def test_demultiplex_script_reads_folder(datadir, tmpdir):
+
+    sample_fn = datadir('input/example01.txt')
+    args = ['demultiplex', '-i', datadir('input'), '-s', sample_fn, '-e', 'example_reads_folder']
+    status, out, err = runscript('pyinseq', args, directory=str(tmpdir), fail_ok=True)
+
+    assert status == 2
+    assert 'Traceback' not in err
+    # Fails before anything is written
+    assert not tmpdir.join('results/example_reads_folder').check()
@@ -1,13 +1,57 @@
 #!/usr/bin/env python3
 
+import contextlib
+import functools
+import hashlib
 import os
 import logging
+import logging.handlers
+import multiprocessing
 import re
+import shutil
+import tempfile
+from collections import OrderedDict
 
 # This controls the stdout logging.
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s - %(message)s', datefmt='%Y-%m-%d %H:%M')
 logger = logging.getLogger('pyinseq')
 
+# Characters not allowed in a filename made by convert_to_filename
+NON_FILENAME_CHARS = re.compile(r'(?u)[^-\w]')
+# str.translate table that deletes the DNA bases (anything left is not DNA)
+DNA_BASES = str.maketrans('', '', 'ACGT')
+# Length of the sample barcodes at the start of each read
+BARCODE_LENGTH = 4
+
+
+class PyinseqError(RuntimeError):
+    """Error in the user's input or environment, reported without a traceback."""
+
+
+@contextlib.contextmanager
+def log_queue_listener():
+    """
+    Yield a queue for the log records of worker processes.
+
+    Records put on the queue (see init_worker_logging) are written by this
+    process's handlers, so workers never write to the log file themselves.
+    """
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(
+        log_queue, *(logging.getLogger().handlers + logger.handlers),
+        respect_handler_level=True)
+    listener.start()
+    try:
+        yield log_queue
+    finally:
+        listener.stop()
+
+
+def init_worker_logging(log_queue):
+    """Process pool initializer: send pyinseq log records to log_queue."""
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    logger.propagate = False
+
 
 def create_experiment_directories(settings):
     """
@@ -23,8 +67,9 @@ def create_experiment_directories(settings):
       |
       +-genome_lookup/     # Genome fna and ftt files, bowtie indexes
 
-    If /experiment directory already exists exit and return error message and
-    the full path of the present directory to the user"""
+    If /experiment directory already exists raise PyinseqError with a message
+    for the user, unless settings.allow_existing is set. Other errors (e.g.
+    permissions) are raised as they are."""
 
     # Check that experiment name has no special characters or spaces
     experiment = convert_to_filename(settings.experiment)
@@ -32,24 +77,25 @@ def create_experiment_directories(settings):
     # ERROR MESSAGES
     errorDirectoryExists = \
         'PyINSeq Error: The directory already exists for experiment {0}\n' \
-        'Delete or rename the {0} directory, or provide a new experiment\n' \
-        'name for the current analysis'.format(experiment)
+        'Delete or rename the {0} directory, provide a new experiment\n' \
+        'name for the current analysis, or use --force to write into it'.format(experiment)
 
-    # Create path or exit with error if it exists.
+    # Create path or raise an error if it exists.
+    exist_ok = settings.allow_existing
     try:
         if settings.process_reads:
-            os.makedirs('results/{}/raw_data/'.format(experiment))
-            logger.info('Make directory: results/{}'.format(experiment))
-            logger.info('Make directory: results/{}/raw_data/'.format(experiment))
+            os.makedirs('results/{}/raw_data/'.format(experiment), exist_ok=exist_ok)
+            logger.info('Make directory: results/%s', experiment)
+            logger.info('Make directory: results/%s/raw_data/', experiment)
         # Only make the genome lookup directory if needed
         if settings.parse_genbank_file:
-            os.makedirs('results/{}/genome_lookup/'.format(experiment))
-            logger.info('Make directory: results/{}/genome_lookup/'.format(experiment))
-    except OSError:
-        print(errorDirectoryExists)
-        exit(1)
+            os.makedirs('results/{}/genome_lookup/'.format(experiment), exist_ok=exist_ok)
+            logger.info('Make directory: results/%s/genome_lookup/', experiment)
+    except FileExistsError:
+        raise PyinseqError(errorDirectoryExists)
 
 
+@functools.lru_cache(maxsize=1024)
 def convert_to_filename(sample_name):
     """
     Convert to a valid filename.
@@ -57,7 +103,94 @@ def convert_to_filename(sample_name):
     Removes leading/trailing whitespace, converts internal spaces to underscores.
     Allows only alphanumeric, dashes, underscores, unicode.
     """
-    return re.sub(r'(?u)[^-\w]', '', sample_name.strip().replace(' ', '_'))
+    return NON_FILENAME_CHARS.sub('', sample_name.strip().replace(' ', '_'))
+
+
+def tab_delimited_samples_to_dict(sample_file):
+    """Read sample names, barcodes from tab-delimited into an OrderedDict."""
+    samplesDict = OrderedDict()
+    # Barcodes seen so far; samplesDict already gives O(1) sample lookups
+    barcodes = set()
+    # The file is small and has no quoting, so it is split in one pass;
+    # blank lines and comment lines are ignored
+    with open(sample_file, 'r') as f:
+        rows = [line.split('\t') for line in f.read().splitlines()
+                if line.strip() and not line.startswith('#')]
+    for row in rows:
+        # sample > filename-acceptable string
+        # barcode > uppercase, without surrounding whitespace
+        sample = convert_to_filename(row[0])
+        barcode = row[1].strip().upper()
+        if len(barcode) != BARCODE_LENGTH or barcode.translate(DNA_BASES):
+            raise PyinseqError('PyINSeq Error: sample {0} barcode {1} is not {2} bases of A, C, G, T'
+                               .format(sample, barcode, BARCODE_LENGTH))
+        if sample in samplesDict or barcode in barcodes:
+            raise PyinseqError('PyINSeq Error: duplicate sample {0} barcode {1}'.format(sample, barcode))
+        samplesDict[sample] = {'barcode': barcode}
+        barcodes.add(barcode)
+    return samplesDict
+
+
+def available_cpus():
+    """Return the number of CPUs this process may run on (at least 1)."""
+    # The affinity mask reflects the CPUs allocated by e.g. a cluster scheduler
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def default_cache_dir():
+    """Return the cache directory: $XDG_CACHE_HOME/pyinseq or ~/.cache/pyinseq."""
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                        'pyinseq')
+
+
+def genome_cache_path(gbkfile, cache_dir):
+    """
+    Return the cache subdirectory for a GenBank file.
+
+    Keyed by the pyinseq version and the SHA-256 of the file's contents, so
+    an edited GenBank file or a new pyinseq release never reuses stale files.
+    """
+    sha = hashlib.sha256()
+    with open(gbkfile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    with open(os.path.join(os.path.dirname(__file__), 'VERSION')) as f:
+        version = f.read().strip()
+    return os.path.join(cache_dir, version, sha.hexdigest()[:16])
+
+
+def restore_from_cache(cache_path, filenames, directory):
+    """
+    Copy filenames from cache_path into directory.
+
+    Returns False (copying nothing) unless every file is in the cache.
+    """
+    if not all(os.path.isfile(os.path.join(cache_path, name)) for name in filenames):
+        return False
+    for name in filenames:
+        shutil.copyfile(os.path.join(cache_path, name), os.path.join(directory, name))
+    return True
+
+
+def save_to_cache(cache_path, filenames, directory):
+    """
+    Copy filenames from directory into cache_path.
+
+    Each file is copied under a temporary name and then renamed, so that
+    concurrent runs never see a partially written file. A cache that cannot
+    be written is logged and otherwise ignored.
+    """
+    try:
+        os.makedirs(cache_path, exist_ok=True)
+        for name in filenames:
+            with tempfile.NamedTemporaryFile(dir=cache_path, delete=False) as fo, \
+                    open(os.path.join(directory, name), 'rb') as fi:
+                shutil.copyfileobj(fi, fo)
+            os.replace(fo.name, os.path.join(cache_path, name))
+    except OSError as e:
+        logger.warning('Could not write to the cache %s: %s', cache_path, e)
 
 
 # ===== Start here ===== #
@@ -12,9 +12,9 @@ finally:
 
 from glob import glob
 
-if sys.version_info < (3, 5):
-    print >> sys.stderr, "ERROR: pyinseq requires python 3.5 or greater"
-    sys.exit()
+if sys.version_info < (3, 7):
+    print("ERROR: pyinseq requires python 3.7 or greater", file=sys.stderr)
+    sys.exit(1)
 
 __version__ = open(os.path.join('pyinseq', 'VERSION')).read().strip()
 
@@ -30,24 +30,30 @@ def main():
             license = 'BSD',
             packages = find_packages(),
             scripts = SCRIPTS,
+            python_requires = '>=3.7',
             setup_requires = ['pytest-runner'],
             tests_require = ['pytest'],
             install_requires = ['matplotlib>=1.5.0',
-                                'seaborn>=0.6.0'
+                                'seaborn>=0.6.0',
                                 'numpy>=1.10.0',
                                 'pandas>=0.18.1',
                                 'pytest>=2.8.1',
                                 'pytest-cov>=2.4.0',
                                 'codecov>=2.0.5',
-                                'PyYAML>=3.11',
-                                'regex>=2016.6.5',
-                                'screed>=0.9'],
+                                'PyYAML>=5.1',
+                                # isal needs python 3.9+; gzip is used without it
+                                'isal>=1.8.0; python_version >= "3.9"'],
             classifiers = ['Development Status :: 4 - Beta',
                            'Intended Audience :: Science/Research',
                            'License :: OSI Approved :: BSD License',
                            'Operating System :: MacOS :: MacOS X',
                            'Operating System :: POSIX',
-                           'Programming Language :: Python :: 3.5',
+                           'Programming Language :: Python :: 3',
+                           'Programming Language :: Python :: 3.7',
+                           'Programming Language :: Python :: 3.8',
+                           'Programming Language :: Python :: 3.9',
+                           'Programming Language :: Python :: 3.10',
+                           'Programming Language :: Python :: 3.11',
                            'Topic :: Scientific/Engineering :: Bio-Informatics',
                            ],
 